@@ -7,6 +7,7 @@ from torch.utils.data import Dataset
 from rdkit import Chem
 from rdkit.Chem import AllChem, Draw, Descriptors, rdmolfiles, rdMolAlign, rdmolops, rdchem, rdMolDescriptors, ChemicalFeatures
 from rdkit.Chem import PeriodicTable, GetPeriodicTable
+from rdkit.Chem import rdFingerprintGenerator
 from rdkit import RDConfig
 from rdkit.Chem.FeatMaps import FeatMaps
 from rdkit.DataStructs import cDataStructs
@@ -16,9 +17,17 @@ from rdkit.ML.Descriptors import MoleculeDescriptors
 from rdkit.Chem.EState import Fingerprinter
 import rdkit.Chem.EState.EState_VSA
 import rdkit.Chem.GraphDescriptors
+import rdkit.Chem.MolSurf
 from inspect import getmembers, isfunction, getfullargspec
 import h5py
 import hashlib
+import threading
+import time
+import atexit
+import multiprocessing.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed, effective_n_jobs
 
 
 try:
@@ -27,7 +36,7 @@ except:
     import pickle
 
 #from utils import *
-from utils import wiener_index, get_feature_score_vector, mask_borders, ndmesh
+from utils import wiener_index, get_feature_score_vector, mask_borders, ndmesh, welford_update
 
 from rdkit.Chem import rdRGroupDecomposition as rdRGD
 from contextlib import contextmanager,redirect_stderr,redirect_stdout
@@ -73,10 +82,180 @@ class dataBlocks(Enum):
     def __int__(self):
         return self.value
     
+# binary fingerprint blocks, stored bit-packed in the combined cache.
+# They come first in dataBlocks, so they always form a prefix of the representation.
+fingerprintBlocks=(dataBlocks.MACCS, dataBlocks.rdkitFP, dataBlocks.minFeatFP, dataBlocks.MorganFP)
 
     
 
+class _CombinedReprCache:
+    # One hdf5 file per representation with contiguous X_bits[N,ceil(n_bits/8)], X[N,D-n_bits] and Y[N,1]
+    # datasets and the ligand IDs of each row. X_bits holds the bit-packed fingerprint prefix of the
+    # representation, X the rest.
+    # Lookups go through a read-only handle that stays open together with its datasets, so their chunk
+    # caches persist. New rows are buffered and appended in bulk under a short write-mode open, so the
+    # file is never held open for writing. Failing to open, lock or read the file only means a cache miss.
+    flush_rows=256 # buffered rows that trigger an append
+    chunk_bytes=1024*1024 # target size of a chunk of rows
+
+    def __init__(self, fn):
+        self.fn=fn
+        self.pid=os.getpid()
+        self.lock=threading.RLock() # iter_prefetch() reads from several threads
+        self._file=None
+        self._dsets={}
+        self._open_failed=False
+        self.n_bits=None
+        self.n_rest=None
+        self.rows={} # ligand ID -> row in the file
+        self.pending={} # ligand ID -> (X, Y, n_bits) not written yet
+
+    def _open(self):
+        if(self._file is None and not self._open_failed and os.path.exists(self.fn)):
+            f=None
+            try:
+                f=h5py.File(self.fn, 'r', rdcc_nbytes=64*1024*1024, rdcc_nslots=10007)
+                self.n_bits=int(f.attrs['n_bits'])
+                self.n_rest=int(f.attrs['n_rest'])
+                self._dsets={name:f[name] for name in ('X_bits','X') if name in f}
+                self.rows={ID:row for row,ID in enumerate(f['IDs'].asstr()[:])}
+                self._file=f
+            except (OSError, KeyError, RuntimeError):
+                # locked by a writer, or damaged; don't retry until after our next write
+                if(f is not None):
+                    f.close()
+                self._dsets={}
+                self.rows={}
+                self._open_failed=True
+        return(self._file)
+
+    def close(self):
+        with self.lock:
+            if(self._file is not None):
+                self._file.close()
+            self._file=None
+            self._dsets={}
+
+    def read(self, lig_ID):
+        with self.lock:
+            if(lig_ID in self.pending):
+                return(self.pending[lig_ID][0].copy()) # callers normalize in place
+            if(self._open() is None or lig_ID not in self.rows):
+                return(None)
+            row=self.rows[lig_ID]
+            X=np.empty(self.n_bits+self.n_rest, dtype=np.float32)
+            try:
+                if('X_bits' in self._dsets):
+                    X[:self.n_bits]=np.unpackbits(self._dsets['X_bits'][row], count=self.n_bits)
+                if('X' in self._dsets):
+                    X[self.n_bits:]=self._dsets['X'][row]
+            except (OSError, RuntimeError):
+                self.close()
+                self._open_failed=True
+                return(None)
+            return(X)
+
+    def add(self, lig_ID, X, Y, n_bits):
+        with self.lock:
+            n_rest=X.shape[0]-n_bits
+            if(self.n_bits is None):
+                self.n_bits=n_bits
+                self.n_rest=n_rest
+            elif(self.n_bits!=n_bits or self.n_rest!=n_rest):
+                # variable length representations (minFeatFP) don't fit the contiguous layout, so don't cache them
+                return
+            self.pending[lig_ID]=(X.copy(), Y, n_bits) # callers normalize X in place
+            if(len(self.pending)>=self.flush_rows):
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if(len(self.pending)==0):
+                return
+            self.close() # hdf5 won't open the file for writing while this process still reads it
+            try:
+                with h5py.File(self.fn, 'a') as f:
+                    if('IDs' not in f):
+                        self._create_datasets(f)
+                    elif(f.attrs['n_bits']!=self.n_bits or f.attrs['n_rest']!=self.n_rest):
+                        self.pending={}
+                        return
+                    # skip rows other datasets or processes have written meanwhile
+                    existing=set(f['IDs'].asstr()[:])
+                    new=[(ID, v) for ID, v in self.pending.items() if ID not in existing]
+                    if(len(new)>0):
+                        start=f['IDs'].shape[0]
+                        end=start+len(new)
+                        for name in ('X_bits','X','Y','IDs'):
+                            if(name in f):
+                                f[name].resize(end, axis=0)
+                        allX=np.stack([v[0] for _, v in new])
+                        if(self.n_bits>0):
+                            f['X_bits'][start:end]=np.packbits(allX[:,:self.n_bits]!=0, axis=1)
+                        if(self.n_rest>0):
+                            f['X'][start:end]=allX[:,self.n_bits:]
+                        f['Y'][start:end]=np.stack([v[1] for _, v in new])
+                        f['IDs'][start:end]=[ID for ID, _ in new]
+            except (OSError, KeyError, RuntimeError):
+                # locked by another process or damaged: keep the rows for a later try, within reason
+                if(len(self.pending)>=4*self.flush_rows):
+                    self.pending={}
+                return
+            self.pending={}
+            self._open_failed=False # reopen for reading, now including the new rows
+
+    def _create_datasets(self, f):
+        f.attrs['n_bits']=self.n_bits
+        f.attrs['n_rest']=self.n_rest
+        n_Y=next(iter(self.pending.values()))[1].shape[0]
+        for name, width, dtype in (('X_bits', (self.n_bits+7)//8, 'u1'), ('X', self.n_rest, 'f4'), ('Y', n_Y, 'f8')):
+            if(width>0):
+                chunk_rows=max(1, self.chunk_bytes//(width*np.dtype(dtype).itemsize))
+                f.create_dataset(name, shape=(0,width), maxshape=(None,width), chunks=(chunk_rows,width), dtype=dtype)
+        f.create_dataset('IDs', shape=(0,), maxshape=(None,), chunks=(4096,), dtype=h5py.string_dtype())
+
+# per process, shared by all datasets using the same cache file
+_combined_caches={}
+_combined_caches_lock=threading.Lock()
+_exit_flush_pids=set()
+
+def _get_combined_cache(fn):
+    with _combined_caches_lock:
+        cache=_combined_caches.get(fn)
+        if(cache is None or cache.pid!=os.getpid()):
+            # after a fork, leave the parent's handle and pending rows alone and open our own
+            cache=_CombinedReprCache(fn)
+            _combined_caches[fn]=cache
+            if(cache.pid not in _exit_flush_pids):
+                # Forked multiprocessing workers (e.g. DataLoader's) leave through os._exit(), skipping atexit,
+                # but run finalizers registered after the fork. Rows still pending are lost if the process is killed
+                # or the file stays locked, e.g. by a reader in the parent; they are regenerated on a later miss.
+                multiprocessing.util.Finalize(None, _flush_combined_caches, exitpriority=10)
+                _exit_flush_pids.add(cache.pid)
+        return(cache)
+
+@atexit.register
+def _flush_combined_caches():
+    for cache in list(_combined_caches.values()):
+        if(cache.pid==os.getpid()):
+            for _ in range(20):
+                cache.flush()
+                if(len(cache.pending)==0):
+                    break
+                time.sleep(0.05) # workers exiting together take turns locking the file
+            cache.close()
+
+
+def _single_arg_functions(module):
+    return(tuple(f for name,f in getmembers(module, isfunction) if name[0]!='_' and len(getfullargspec(f)[0])==1))
+
 class CustomMolModularDataset(Dataset):
+    # descriptor calculators and function lists only depend on rdkit, not on the ligand, so build them once.
+    # Class attributes rather than instance ones: GraphDescriptors contains lambdas, which don't pickle.
+    _desc_calc=MoleculeDescriptors.MolecularDescriptorCalculator([x[0] for x in Descriptors._descList])
+    _graph_funcs=_single_arg_functions(rdkit.Chem.GraphDescriptors)
+    _MOE_funcs=_single_arg_functions(rdkit.Chem.MolSurf)
+
     def __init__(self, ligs,
                  representation_flags=[1]*(len(dataBlocks)-1), molecular_db_file=None,
                  out_folder=os.path.split(os.path.realpath(__file__))[0], datafolder=os.path.split(os.path.realpath(__file__))[0],
@@ -97,38 +276,48 @@ class CustomMolModularDataset(Dataset):
         self.use_cache=use_cache
         self.use_hdf5_cache=use_hdf5_cache
         self.use_combined_cache=use_combined_cache
+        self._block_sizes=None # lengths of the active blocks, known after the first transform()
+        self._total_dim=None
         
         self._internal_cache_maxMem=internal_cache_maxMem_MB*1024*1024 # 512 MB by default
         
         if(X_filter is not None):
             if type(X_filter) is np.ndarray:
                 if(X_filter.ndim!=1):
-                    raise ValueError("X_filter should a 1D array or a filename of a pickled 1D array.")
+                    raise ValueError("X_filter should a 1D array or a filename of a pickled or .npy 1D array.")
                 self.X_filter=X_filter
             elif(not os.path.exists(X_filter)):
                 raise(Exception(f"No such file: {X_filter}"))
+            elif(X_filter.endswith('.npy')):
+                self.X_filter=np.load(X_filter)
             else:
                 with open(X_filter, 'rb') as f:
                     self.X_filter=pickle.load(f)
+        # names the normalization factors cache, so hash only once
+        self._filter_hash=None
+        if(self.X_filter is not None):
+            self._filter_hash=hashlib.md5(np.packbits(np.array(self.X_filter, dtype=bool)).tobytes()).hexdigest()
         self.ligs=ligs
-        if(self.representation_flags[int(dataBlocks.minFeatFP)]):
-            fdefName = self.out_folder+'/MinimalFeatures.fdef'
-            featFactory = ChemicalFeatures.BuildFeatureFactory(fdefName)
-            self.sigFactory = SigFactory(featFactory,minPointCount=2,maxPointCount=3, trianglePruneBins=False)
-            self.sigFactory.SetBins([(0,2),(2,5),(5,8)])
-            self.sigFactory.Init()
+        # targets, looked up in the rdkit property maps only once
+        self._Y=np.array([float(lig.GetProp('dG')) if lig.HasProp('dG') else np.nan for lig in ligs]).reshape(-1,1) # kcal/mol
         
+        # enum lookups of the active blocks, done once instead of per block per ligand
+        self._active_block_ids=[dataBlocks(int(i)) for i in self.active_flags]
+        self._active_block_names=[b.name for b in self._active_block_ids]
+        self._active_fns=[self._block_fns[b] for b in self._active_block_ids]
+        self._init_fp_generators()
 
             
 
         #representation cache path precalc
         
         #repr_hash=str(abs(hash(np.array(self.representation_flags, dtype=int).tobytes())))[:5]
-        repr_hash=hashlib.md5(np.packbits(np.array(representation_flags, dtype=bool)).tobytes()).hexdigest()
         if(cachefolder is None):
+            repr_hash=hashlib.md5(np.packbits(np.array(representation_flags, dtype=bool)).tobytes()).hexdigest()
             self.cachefolder=f"{self.datafolder}/combined_modular_repr_cache/{repr_hash}"        
         else:
             self.cachefolder=cachefolder
+        self._combined_cache_fn=self.cachefolder+'/cache.h5'
         if (self.use_combined_cache and not os.path.exists(self.cachefolder)): #make sure the folder exists
             try:
                 os.makedirs(self.cachefolder)
@@ -154,52 +343,103 @@ class CustomMolModularDataset(Dataset):
             for i in range(len(self.representation_flags)):
                 if(self.representation_flags[i]):
                     self.hdf5_repr_cache_files[i].close()
+
+    def __getstate__(self):
+        # open hdf5 files can't be pickled, so copies sent to worker processes work without the hdf5 cache
+        state=self.__dict__.copy()
+        if(self.use_hdf5_cache):
+            state['use_hdf5_cache']=False
+            state.pop('hdf5_repr_cache_files', None)
+        # fingerprint generators don't pickle, rebuild them on the other side
+        state.pop('_morgan_gen', None)
+        state.pop('_rdkitFP_gen', None)
+        state.pop('sigFactory', None)
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_fp_generators()
+
+    def _init_fp_generators(self):
+        # reused across ligands; same bits as GetMorganFingerprintAsBitVect(lig, 2) and RDKFingerprint(lig)
+        self._morgan_gen=rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=2048)
+        self._rdkitFP_gen=rdFingerprintGenerator.GetRDKitFPGenerator(fpSize=2048)
+        if(self.representation_flags[int(dataBlocks.minFeatFP)]):
+            fdefName = self.out_folder+'/MinimalFeatures.fdef'
+            featFactory = ChemicalFeatures.BuildFeatureFactory(fdefName)
+            self.sigFactory = SigFactory(featFactory,minPointCount=2,maxPointCount=3, trianglePruneBins=False)
+            self.sigFactory.SetBins([(0,2),(2,5),(5,8)])
+            self.sigFactory.Init()
                     
     def find_ranges(self):
-        allX=np.array([entry[0] for entry in self])
-        allrange=np.zeros((allX.shape[1],2))
-        # allX axis 0 loops over ligands
-        allrange[:,0]=np.min(allX, axis=0)
-        allrange[:,1]=np.max(allX, axis=0)
+        # single streaming pass over ligands, without materializing all of X
+        x,_=self[0]
+        allrange=np.zeros((x.shape[0],2))
+        allrange[:,0]=x
+        allrange[:,1]=x
+        for i in range(1,len(self)):
+            x,_=self[i]
+            np.minimum(allrange[:,0], x, out=allrange[:,0])
+            np.maximum(allrange[:,1], x, out=allrange[:,1])
         return(allrange)
 
-    def find_normalization_factors(self):
-        # read the normalization cache if it was previusly saved
+    def _read_normalization_factors(self, fn_base):
+        # float32 .npz, or the older text format
+        if(os.path.exists(fn_base+".npz")):
+            with np.load(fn_base+".npz") as data:
+                return(data['mu'], data['width'])
+        elif(os.path.exists(fn_base+".dat")):
+            temp=np.loadtxt(fn_base+".dat")
+            temp=temp.astype(np.float32) # defaults to float64, which translates to torch's double and is incompatible with linear layers
+            return(temp[0,:], temp[1,:])
+        return(None)
+
+    def _normalization_factors_fn(self):
         filt_spec="_no_X_filter"
-        fn_no_filt=f"{self.cachefolder}/normalization_factors_{filt_spec}.dat"
         if(self.X_filter is not None):
-            filt_hash=hashlib.md5(np.packbits(np.array(self.X_filter, dtype=bool)).tobytes()).hexdigest()
-            filt_spec="_fiter_hash_"+filt_hash
-        fn=f"{self.cachefolder}/normalization_factors_{filt_spec}.dat"
-        if(os.path.exists(fn)):
-            temp=np.loadtxt(fn)
-            temp=temp.astype(np.float32) # defaults to float64, which translates to torch's double and is incompatible with linear layers
-            self.norm_mu=temp[0,:]
-            self.norm_width=temp[1,:]
-            if(self.verbose):
-                print(f"Reading normalization factors for a {norm_mu.shape} dataset")
-        elif(os.path.exists(fn_no_filt) and self.X_filter is not None):
-            temp=np.loadtxt(fn_no_filt)
-            temp=temp.astype(np.float32) # defaults to float64, which translates to torch's double and is incompatible with linear layers
-            self.norm_mu=temp[0,self.X_filter]
-            self.norm_width=temp[1,self.X_filter]
-            if(self.verbose):
-                print(f"Reading normalization factors for a {norm_mu.shape} dataset")
-        else:
+            filt_spec="_fiter_hash_"+self._filter_hash
+        return(f"{self.cachefolder}/normalization_factors_{filt_spec}")
+
+    def _load_saved_normalization_factors(self):
+        # read the normalization cache if it was previusly saved
+        fn_no_filt=f"{self.cachefolder}/normalization_factors__no_X_filter"
+        saved=self._read_normalization_factors(self._normalization_factors_fn())
+        if(saved is None and self.X_filter is not None):
+            saved_no_filt=self._read_normalization_factors(fn_no_filt)
+            if(saved_no_filt is not None):
+                saved=(saved_no_filt[0][self.X_filter], saved_no_filt[1][self.X_filter])
+        if(saved is None):
+            return(False)
+        self.norm_mu, self.norm_width = saved
+        if(self.verbose):
+            print(f"Reading normalization factors for a {self.norm_mu.shape} dataset")
+        return(True)
+
+    def _save_normalization_factors(self, mean, M2):
+        # from the accumulators of a Welford pass over the whole dataset
+        self.norm_mu=mean.astype(np.float32)
+        self.norm_width=np.sqrt(M2/len(self)).astype(np.float32)
+        self.norm_width[self.norm_width<1e-7]=1.0 # if standard deviation is 0, don't scale
+        if not os.path.exists(self.cachefolder): #make sure the folder exists
+            os.makedirs(self.cachefolder, exist_ok=True)
+        np.savez_compressed(self._normalization_factors_fn()+".npz", mu=self.norm_mu, width=self.norm_width)
+        if(self.verbose):
+            print(f"Generating normalization factors for a {(len(self), self.norm_mu.shape[0])} dataset")
+
+    def find_normalization_factors(self):
+        if(not self._load_saved_normalization_factors()):
             self.normalize_x=False
-            allX=np.array([entry[0] for entry in self])
-            self.norm_mu=np.mean(allX, axis=0)
-            self.norm_width=np.std(allX, axis=0)
-            self.norm_width[self.norm_width<1e-7]=1.0 # if standard deviation is 0, don't scale
+            # Welford's online algorithm: one pass over ligands, without materializing all of X
+            x,_=self[0]
+            mean=np.zeros(x.shape[0])
+            M2=np.zeros(x.shape[0])
+            for i in range(len(self)):
+                if(i>0):
+                    x,_=self[i]
+                welford_update(mean, M2, x, i+1)
+            self._flush_combined_cache()
+            self._save_normalization_factors(mean, M2)
             self.normalize_x=True
-            
-            # save normalization factors
-            if not os.path.exists(self.cachefolder): #make sure the folder exists
-                os.makedirs(self.cachefolder, exist_ok=True)
-            np.savetxt(fn, np.vstack((self.norm_mu, self.norm_width)))
-            
-            if(self.verbose):
-                print(f"Generating normalization factors for a {allX.shape} dataset")
         self.build_internal_filtered_cache()
         _=gc.collect()
 
@@ -213,17 +453,26 @@ class CustomMolModularDataset(Dataset):
     def build_internal_filtered_cache(self):
         if(self.norm_mu is None and self.normalize_x):
             raise(Exception("call build_internal_filtered_cache() only after normalization!"))
-        neededMem=len(self)*(self[0][0].shape[0]+self[0][1].shape[0])*self[0][1].itemsize
+        first=self[0] # reused below, each self[idx] can mean recomputing the representation
+        neededMem=len(self)*(first[0].shape[0]+first[1].shape[0])*first[1].itemsize
         if(neededMem>self._internal_cache_maxMem):
             print(f"Building the internal_filtered_cache needs {neededMem/1024/1024} MB, more than the {self._internal_cache_maxMem/1024/1024} MB limit. SKIPPING and will read samples from HDD each time instead.")
             return()
-        allX=[]
-        allY=[]
-        for entry in self: # loop over self only once
-            allX.append(entry[0])
-            allY.append(entry[1])
-        allX=np.array(allX)
-        allY=np.array(allY)
+        allX=np.empty((len(self), first[0].shape[0]), dtype=np.float32) # float64 would become torch's double, incompatible with linear layers
+        allY=np.empty((len(self), first[1].shape[0]), dtype=first[1].dtype)
+        allX[0]=first[0]
+        allY[0]=first[1]
+        for i in range(1,len(self)): # loop over self only once
+            allX[i], allY[i] = self[i]
+        self._flush_combined_cache()
+        self._set_internal_filtered_cache(allX, allY)
+
+
+    def _set_internal_filtered_cache(self, allX, allY):
+        # C-contiguous, aligned float32 rows, so __getitem__ returns contiguous views
+        # that torch can wrap during batch collation without an extra copy
+        allX=np.require(allX, dtype=np.float32, requirements=['C','A'])
+        allY=np.require(allY, requirements=['C','A'])
         self.internal_filtered_cache=(allX, allY)
         if(self.verbose):
             print(f"saving an internal filtered & normalized cache of shape ({self.internal_filtered_cache[0].shape},{self.internal_filtered_cache[1].shape})")
@@ -240,175 +489,291 @@ class CustomMolModularDataset(Dataset):
         return len(self.ligs)
 
     def __getitem__(self, idx):
-        lig = self.ligs[idx]
-
         if(self.internal_filtered_cache is None):
-            lig_ID = lig.GetProp("ID")
-            #check combined repr cache
-            cache_fn = self.cachefolder+'/'+lig_ID+'.pickle'
-            if(self.use_combined_cache and os.path.isfile(cache_fn)):
-                with open(cache_fn, 'rb') as f:
-                    X, Y = pickle.load(f)
-            else:
-                X = self.transform(idx).astype(np.float32)
-                Y = np.array([float(lig.GetProp('dG')) if lig.HasProp('dG') else np.nan]) # kcal/mol
-                #save cache
-                if(self.use_combined_cache):
-                    with open(cache_fn, 'wb') as f:
-                        pickle.dump((X, Y), f)
-            #if(self.X_filter):
-            if(not self.X_filter is None):
-                X=X[self.X_filter]
-            if(self.normalize_x):
-                #print(f"{lig_ID} width: {X.shape}")
-                X=self.normalize_input(X)
+            X, Y = self._compute_one(idx)
+            X = self._filter_and_normalize(X)
                 
         else:
             X=self.internal_filtered_cache[0][idx]
             Y=self.internal_filtered_cache[1][idx]
         
         return X, Y
+
+    def _compute_one(self, idx):
+        # unfiltered and unnormalized representation of a single ligand
+        lig_ID = self.ligs[idx].GetProp("ID")
+        #check combined repr cache
+        if(self.use_combined_cache):
+            cached=_get_combined_cache(self._combined_cache_fn).read(lig_ID)
+            if(cached is not None):
+                return cached, self._Y[idx].copy() # callers may modify Y in place
+        X, Y, n_bits = self._generate_one(idx)
+        #save cache, written to disk in bulk
+        if(self.use_combined_cache):
+            _get_combined_cache(self._combined_cache_fn).add(lig_ID, X, Y, n_bits)
+        return X, Y.copy()
+
+    def _generate_one(self, idx):
+        # also returns the length of the binary fingerprint prefix of X
+        X, block_sizes = self._transform(idx)
+        return X, self._Y[idx], self._fingerprint_bits(block_sizes)
+
+    def _fingerprint_bits(self, block_sizes):
+        return(sum(size for b,size in zip(self._active_block_ids, block_sizes) if b in fingerprintBlocks))
+
+    def _flush_combined_cache(self):
+        if(self.use_combined_cache):
+            _get_combined_cache(self._combined_cache_fn).flush()
+
+    def _filter_and_normalize(self, X):
+        # X is always a freshly made array here, so it can be normalized in place
+        #if(self.X_filter):
+        if(not self.X_filter is None):
+            X=X[self.X_filter]
+        if(self.normalize_x):
+            #print(f"{lig_ID} width: {X.shape}")
+            if(self.norm_mu is None):
+                self.find_normalization_factors()
+            np.subtract(X, self.norm_mu, out=X)
+            np.divide(X, self.norm_width, out=X)
+        return X
+
+    def precompute_all(self, n_jobs=-1):
+        # parallel alternative to find_normalization_factors() + build_internal_filtered_cache();
+        # most rdkit descriptors hold the GIL, so use processes.
+        # Samples are generated once; if normalization factors are still needed they come from the same pass.
+        need_stats=self.normalize_x and self.norm_mu is None and not self._load_saved_normalization_factors()
+
+        def filtered(X):
+            return(X[self.X_filter] if self.X_filter is not None else X)
+
+        X, Y = self._compute_one(0)
+        X = filtered(X)
+        neededMem=len(self)*(X.shape[0]+Y.shape[0])*Y.itemsize
+        store=neededMem<=self._internal_cache_maxMem
+        if(not store):
+            print(f"Building the internal_filtered_cache needs {neededMem/1024/1024} MB, more than the {self._internal_cache_maxMem/1024/1024} MB limit. SKIPPING and will read samples from HDD each time instead.")
+            if(not need_stats):
+                return()
+        if(store):
+            allX=np.empty((len(self), X.shape[0]), dtype=np.float32)
+            allY=np.empty((len(self), Y.shape[0]), dtype=Y.dtype)
+        if(need_stats):
+            mean=np.zeros(X.shape[0])
+            M2=np.zeros(X.shape[0])
+        count=0
+
+        def consume(idx, X):
+            # filtered but not yet normalized X
+            nonlocal count
+            if(need_stats):
+                count+=1
+                welford_update(mean, M2, X, count)
+            if(store):
+                allX[idx]=X
+                allY[idx]=self._Y[idx]
+
+        consume(0, X)
+        # read what is already cached here, so that only this process writes to the combined cache
+        missing=[]
+        if(self.use_combined_cache):
+            cache=_get_combined_cache(self._combined_cache_fn)
+        for idx in range(1,len(self)):
+            X=cache.read(self.ligs[idx].GetProp("ID")) if self.use_combined_cache else None
+            if(X is None):
+                missing.append(idx)
+            else:
+                consume(idx, filtered(X))
+        if(len(missing)>0):
+            # Workers only get the binaries of their own chunk of ligands, not the dataset.
+            # Waves of limited size, so only that many unfiltered samples are held at once.
+            n_chunks=4*effective_n_jobs(n_jobs)
+            chunk_size=32
+            pickle_flags=Chem.PropertyPickleOptions.CoordsAsDouble # 3D descriptors need exact coordinates
+            with Parallel(n_jobs=n_jobs, backend='loky') as parallel:
+                for start in range(0, len(missing), n_chunks*chunk_size):
+                    wave=missing[start:start+n_chunks*chunk_size]
+                    chunks=[wave[i:i+chunk_size] for i in range(0, len(wave), chunk_size)]
+                    results=parallel(delayed(_generate_chunk)([self.ligs[idx].ToBinary(pickle_flags) for idx in c],
+                                                              self.representation_flags, self.out_folder) for c in chunks)
+                    for chunk_idxs, chunk in zip(chunks, results):
+                        for idx, (X, n_bits) in zip(chunk_idxs, chunk):
+                            if(self.use_combined_cache):
+                                cache.add(self.ligs[idx].GetProp("ID"), X, self._Y[idx], n_bits)
+                            consume(idx, filtered(X))
+        self._flush_combined_cache()
+        if(need_stats):
+            self._save_normalization_factors(mean, M2)
+        if(store):
+            if(self.normalize_x):
+                np.subtract(allX, self.norm_mu, out=allX)
+                np.divide(allX, self.norm_width, out=allX)
+            self._set_internal_filtered_cache(allX, allY)
             
+    def iter_prefetch(self, n_prefetch=8):
+        # opt-in ordered iteration that reads/generates the next n_prefetch samples in background threads
+        if(self.normalize_x and self.norm_mu is None):
+            self.find_normalization_factors() # not from inside the threads
+        with ThreadPoolExecutor(max_workers=n_prefetch) as pool:
+            futures=deque()
+            for idx in range(len(self)):
+                futures.append(pool.submit(self.__getitem__, idx))
+                if(len(futures)>n_prefetch):
+                    yield futures.popleft().result()
+            while(futures):
+                yield futures.popleft().result()
+
     def generate_DataBlock(self, lig, blockID):
         blockID=dataBlocks(blockID)
-        
-        if(blockID==dataBlocks.MACCS):
-            Chem.GetSymmSSSR(lig)
-            MACCS_txt=cDataStructs.BitVectToText(rdMolDescriptors.GetMACCSKeysFingerprint(lig))
-            MACCS_arr=np.zeros(len(MACCS_txt), dtype=np.uint8)
-            for j in range(len(MACCS_txt)):
-                if(MACCS_txt[j]=="1"):
-                    MACCS_arr[j]=1;
-            return(MACCS_arr)
-        
-        elif(blockID==dataBlocks.MorganFP):
-            Chem.GetSymmSSSR(lig)
-            Morgan_txt=cDataStructs.BitVectToText(rdMolDescriptors.GetMorganFingerprintAsBitVect(lig, 2))
-            Morgan_arr=np.zeros(len(Morgan_txt), dtype=np.uint8)
-            for j in range(len(Morgan_txt)):
-                if(Morgan_txt[j]=="1"):
-                    Morgan_arr[j]=1;
-            return(Morgan_arr)
-        
-        elif(blockID==dataBlocks.rdkitFP):
-            Chem.GetSymmSSSR(lig)
-            rdkitFingerprint_txt=cDataStructs.BitVectToText(Chem.rdmolops.RDKFingerprint(lig))
-            rdkitFingerprint_arr=np.zeros(len(rdkitFingerprint_txt), dtype=np.uint8)
-            for j in range(len(rdkitFingerprint_txt)):
-                if(rdkitFingerprint_txt[j]=="1"):
-                    rdkitFingerprint_arr[j]=1;
-            return(rdkitFingerprint_arr)
-        
-        elif(blockID==dataBlocks.minFeatFP):
-           Chem.GetSymmSSSR(lig)
-           minFeatFingerprint_txt=cDataStructs.BitVectToText(Generate.Gen2DFingerprint(lig, self.sigFactory))
-           minFeatFingerprint_arr=np.zeros(len(minFeatFingerprint_txt), dtype=np.uint8)
-           for j in range(len(minFeatFingerprint_txt)):
-               if(minFeatFingerprint_txt[j]=="1"):
-                   minFeatFingerprint_arr[j]=1;
-           return(minFeatFingerprint_arr)
-    
-        elif(blockID==dataBlocks.Descriptors):
-            nms=[x[0] for x in Descriptors._descList]
-            calc = MoleculeDescriptors.MolecularDescriptorCalculator(nms)
-            des = np.array(calc.CalcDescriptors(lig))
-            return(des)
-        
-        elif(blockID==dataBlocks.EState_FP):
-            ES=Fingerprinter.FingerprintMol(lig)
-            funcs=getmembers(rdkit.Chem.GraphDescriptors, isfunction)
-            funcs=[f[1] for f in funcs if f[0][0]!='_' and len(getfullargspec(f[1])[0])==1]
-            ES_VSA=np.array([f(lig) for f in funcs])
-            ES_FP=np.concatenate((ES[0],ES[1],ES_VSA))
-            return(ES_FP)
-    
-        elif(blockID==dataBlocks.Graph_desc):
-            funcs=getmembers(rdkit.Chem.GraphDescriptors, isfunction)
-            funcs=[f[1] for f in funcs if f[0][0]!='_' and len(getfullargspec(f[1])[0])==1]
-            funcs+=[wiener_index]
-            graph_desc=np.array([f(lig) for f in funcs])
-            return(graph_desc)
-    
-        
-        #extras
-        elif(blockID==dataBlocks.MOE):
-            funcs=getmembers(rdkit.Chem.MolSurf, isfunction)
-            funcs=[f[1] for f in funcs if f[0][0]!='_' and len(getfullargspec(f[1])[0])==1]
-            MOE=np.array([f(lig) for f in funcs])
-            return(MOE)
-        elif(blockID==dataBlocks.MQN):
-            return(np.array(rdMolDescriptors.MQNs_(lig) ))
-        elif(blockID==dataBlocks.GETAWAY):
-            return(np.array(rdMolDescriptors.CalcGETAWAY(lig) ))
-        elif(blockID==dataBlocks.AUTOCORR2D):
-            return(np.array(rdMolDescriptors.CalcAUTOCORR2D(lig) ))
-        elif(blockID==dataBlocks.AUTOCORR3D):
-            return(np.array(rdMolDescriptors.CalcAUTOCORR3D(lig) ))
-        elif(blockID==dataBlocks.BCUT2D):
-            return(np.array(rdMolDescriptors.BCUT2D(lig) ))
-        elif(blockID==dataBlocks.WHIM):
-            return(np.array(rdMolDescriptors.CalcWHIM(lig) ))
-        elif(blockID==dataBlocks.RDF):
-            return(np.array(rdMolDescriptors.CalcRDF(lig) ))
-        elif(blockID==dataBlocks.USR):
-            return(np.array(rdMolDescriptors.GetUSR(lig) ))
-        elif(blockID==dataBlocks.USRCUT):
-            return(np.array(rdMolDescriptors.GetUSRCAT(lig) ))
-        elif(blockID==dataBlocks.PEOE_VSA):
-            return(np.array(rdMolDescriptors.PEOE_VSA_(lig) ))
-        elif(blockID==dataBlocks.SMR_VSA):
-            return(np.array(rdMolDescriptors.SMR_VSA_(lig) ))
-        elif(blockID==dataBlocks.SlogP_VSA):
-            return(np.array(rdMolDescriptors.SlogP_VSA_(lig) ))
-        elif(blockID==dataBlocks.MORSE):
-            return(np.array(rdMolDescriptors.CalcMORSE(lig) ))
-            
-        else:
+        if(blockID not in self._block_fns):
             raise(Exception(f"Unsupported dataBlock requested: {blockID}"))
+        Chem.GetSymmSSSR(lig)
+        return(self._block_fns[blockID](self, lig))
+
+    def _MACCS_block(self, lig):
+        MACCS_bv=rdMolDescriptors.GetMACCSKeysFingerprint(lig)
+        MACCS_arr=np.zeros(MACCS_bv.GetNumBits(), dtype=np.uint8)
+        cDataStructs.ConvertToNumpyArray(MACCS_bv, MACCS_arr)
+        return(MACCS_arr)
+
+    def _MorganFP_block(self, lig):
+        Morgan_bv=self._morgan_gen.GetFingerprint(lig)
+        Morgan_arr=np.zeros(Morgan_bv.GetNumBits(), dtype=np.uint8)
+        cDataStructs.ConvertToNumpyArray(Morgan_bv, Morgan_arr)
+        return(Morgan_arr)
+
+    def _rdkitFP_block(self, lig):
+        rdkitFingerprint_bv=self._rdkitFP_gen.GetFingerprint(lig)
+        rdkitFingerprint_arr=np.zeros(rdkitFingerprint_bv.GetNumBits(), dtype=np.uint8)
+        cDataStructs.ConvertToNumpyArray(rdkitFingerprint_bv, rdkitFingerprint_arr)
+        return(rdkitFingerprint_arr)
+
+    def _minFeatFP_block(self, lig):
+        minFeatFingerprint_bv=Generate.Gen2DFingerprint(lig, self.sigFactory)
+        minFeatFingerprint_arr=np.zeros(minFeatFingerprint_bv.GetNumBits(), dtype=np.uint8)
+        # Gen2DFingerprint returns a SparseBitVect, which ConvertToNumpyArray doesn't take
+        minFeatFingerprint_arr[list(minFeatFingerprint_bv.GetOnBits())]=1
+        return(minFeatFingerprint_arr)
+
+    def _Descriptors_block(self, lig):
+        des = np.array(self._desc_calc.CalcDescriptors(lig))
+        return(des)
+
+    def _EState_FP_block(self, lig):
+        ES=Fingerprinter.FingerprintMol(lig)
+        ES_VSA=np.array([f(lig) for f in self._graph_funcs])
+        ES_FP=np.concatenate((ES[0],ES[1],ES_VSA))
+        return(ES_FP)
+
+    def _Graph_desc_block(self, lig):
+        graph_desc=np.array([f(lig) for f in self._graph_funcs+(wiener_index,)])
+        return(graph_desc)
+
+    #extras
+    def _MOE_block(self, lig):
+        MOE=np.array([f(lig) for f in self._MOE_funcs])
+        return(MOE)
+    def _MQN_block(self, lig):
+        return(np.array(rdMolDescriptors.MQNs_(lig) ))
+    def _GETAWAY_block(self, lig):
+        return(np.array(rdMolDescriptors.CalcGETAWAY(lig) ))
+    def _AUTOCORR2D_block(self, lig):
+        return(np.array(rdMolDescriptors.CalcAUTOCORR2D(lig) ))
+    def _AUTOCORR3D_block(self, lig):
+        return(np.array(rdMolDescriptors.CalcAUTOCORR3D(lig) ))
+    def _BCUT2D_block(self, lig):
+        return(np.array(rdMolDescriptors.BCUT2D(lig) ))
+    def _WHIM_block(self, lig):
+        return(np.array(rdMolDescriptors.CalcWHIM(lig) ))
+    def _RDF_block(self, lig):
+        return(np.array(rdMolDescriptors.CalcRDF(lig) ))
+    def _USR_block(self, lig):
+        return(np.array(rdMolDescriptors.GetUSR(lig) ))
+    def _USRCUT_block(self, lig):
+        return(np.array(rdMolDescriptors.GetUSRCAT(lig) ))
+    def _PEOE_VSA_block(self, lig):
+        return(np.array(rdMolDescriptors.PEOE_VSA_(lig) ))
+    def _SMR_VSA_block(self, lig):
+        return(np.array(rdMolDescriptors.SMR_VSA_(lig) ))
+    def _SlogP_VSA_block(self, lig):
+        return(np.array(rdMolDescriptors.SlogP_VSA_(lig) ))
+    def _MORSE_block(self, lig):
+        return(np.array(rdMolDescriptors.CalcMORSE(lig) ))
+
+    # dataBlock -> function generating it, called as fn(self, lig).
+    # Plain functions rather than bound methods, so they pickle by reference.
+    _block_fns={
+        dataBlocks.MACCS: _MACCS_block,
+        dataBlocks.rdkitFP: _rdkitFP_block,
+        dataBlocks.minFeatFP: _minFeatFP_block,
+        dataBlocks.MorganFP: _MorganFP_block,
+        dataBlocks.Descriptors: _Descriptors_block,
+        dataBlocks.EState_FP: _EState_FP_block,
+        dataBlocks.Graph_desc: _Graph_desc_block,
+        dataBlocks.MOE: _MOE_block,
+        dataBlocks.MQN: _MQN_block,
+        dataBlocks.GETAWAY: _GETAWAY_block,
+        dataBlocks.AUTOCORR2D: _AUTOCORR2D_block,
+        dataBlocks.AUTOCORR3D: _AUTOCORR3D_block,
+        dataBlocks.BCUT2D: _BCUT2D_block,
+        dataBlocks.WHIM: _WHIM_block,
+        dataBlocks.RDF: _RDF_block,
+        dataBlocks.USR: _USR_block,
+        dataBlocks.USRCUT: _USRCUT_block,
+        dataBlocks.PEOE_VSA: _PEOE_VSA_block,
+        dataBlocks.SMR_VSA: _SMR_VSA_block,
+        dataBlocks.SlogP_VSA: _SlogP_VSA_block,
+        dataBlocks.MORSE: _MORSE_block,
+    }
         
         
             
 
     def transform(self, lig_idx):
-        vecs=[]
-        #for i in range(len(self.representation_flags)):
-        #    if(self.representation_flags[i]):
-                
-        for i in self.active_flags:
-            #where are the block chaches?
-            cache_folder=self.datafolder+"/modular_repr_cache/"+dataBlocks(i).name+"/"
-                            
-            if not os.path.exists(cache_folder): #make sure the folder exists
-                try:
-                    os.makedirs(cache_folder)
-                except OSError as e:
-                    if e.errno != errno.EEXIST:
-                        raise
-                    
-            #if block is cached, read it
-            lig_ID = self.ligs[lig_idx].GetProp("ID")
-            cache_fn = cache_folder+'/'+lig_ID+'.pickle'
-            hdf5_tn=f"/{dataBlocks(i).name}/{lig_ID}"
-            # if(self.use_hdf5_cache and hdf5_tn in self.hdf5_repr_cache_files[i]): #try hdf5 cache first
-            #     X_block_rep=self.hdf5_repr_cache_files[i][hdf5_tn][:]
-            # elif(os.path.isfile(cache_fn)): #try pickle cache second
-            #     with open(cache_fn, 'rb') as f:
-            #         X_block_rep = pickle.load(f)
-            #     if(self.use_hdf5_cache): # also make the hdf5 cache from pickles
-            #         self.hdf5_repr_cache_files[i].create_dataset(hdf5_tn, data=X_block_rep, dtype='f')
-            # else: #generate a block and cache it otherwize
-            X_block_rep = self.generate_DataBlock(self.ligs[lig_idx], i)
-                    
-                # if(self.use_cache):
-                #     with open(cache_fn, 'wb') as f:
-                #         pickle.dump(X_block_rep, f)
-                # if(self.use_hdf5_cache):
-                #     self.hdf5_repr_cache_files[i].create_dataset(hdf5_tn, data=X_block_rep, dtype='f')
-            
-            #add to overall representation
-            vecs.append(X_block_rep)
-        return(np.concatenate(tuple(vecs), axis=0))
+        return(self._transform(lig_idx)[0])
+
+    def _transform(self, lig_idx):
+        # float32 representation and the lengths of its blocks
+        if(self._block_sizes is None or self.representation_flags[int(dataBlocks.minFeatFP)]):
+            # minFeatFP length varies between ligands, so its layout can't be reused
+            blocks=self.transform_blocks(lig_idx)
+            block_sizes=[b.shape[0] for b in blocks]
+            if(not self.representation_flags[int(dataBlocks.minFeatFP)]):
+                self._block_sizes=block_sizes
+                self._total_dim=sum(block_sizes)
+            return(np.concatenate(tuple(blocks), axis=0).astype(np.float32), block_sizes)
+        # known layout: write blocks straight into the output instead of concatenating
+        out=np.empty(self._total_dim, dtype=np.float32)
+        off=0
+        lig=self.ligs[lig_idx]
+        Chem.GetSymmSSSR(lig) # ring perception once for all blocks
+        for fn,size in zip(self._active_fns, self._block_sizes):
+            out[off:off+size]=fn(self, lig)
+            off+=size
+        return(out, self._block_sizes)
 
+    def transform_blocks(self, lig_idx):
+        vecs=[]
+        lig=self.ligs[lig_idx]
+        Chem.GetSymmSSSR(lig) # ring perception once for all blocks
+        for fn in self._active_fns:
+            # the per-block pickle/hdf5 caches used to be looked up here; the combined cache replaced them
+            vecs.append(fn(self, lig))
+        return(vecs)
 
 
+# precompute_all() worker processes keep one dataset per representation for generating blocks
+_worker_datasets={}
 
+def _generate_chunk(lig_binaries, representation_flags, out_folder):
+    # unfiltered representations and fingerprint prefix lengths of a chunk of ligands
+    key=(tuple(representation_flags), out_folder)
+    if(key not in _worker_datasets):
+        _worker_datasets[key]=CustomMolModularDataset([], representation_flags=representation_flags, out_folder=out_folder, use_combined_cache=False)
+    ds=_worker_datasets[key]
+    results=[]
+    for lig_binary in lig_binaries:
+        ds.ligs=[Chem.Mol(lig_binary)]
+        X, block_sizes = ds._transform(0)
+        results.append((X, ds._fingerprint_bits(block_sizes)))
+    return(results)
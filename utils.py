@@ -136,6 +136,22 @@ def wiener_index(m):
             res += amat[i][j]
     return res
 
+# welford_update(mean, M2, x, count): one in-place step of Welford's online mean/variance algorithm; count includes x
+try:
+    from numba import njit
+    # fused loop, no temporaries per sample. No fastmath, descriptors can be NaN/inf.
+    @njit(cache=True)
+    def welford_update(mean, M2, x, count):
+        for j in range(x.shape[0]):
+            delta=x[j]-mean[j]
+            mean[j]+=delta/count
+            M2[j]+=delta*(x[j]-mean[j])
+except ImportError:
+    def welford_update(mean, M2, x, count):
+        delta=x-mean
+        mean+=delta/count
+        M2+=delta*(x-mean)
+
 def get_feature_score_vector(lig_fmap, xray_fmap):
     #http://rdkit.blogspot.com/2017/11/using-feature-maps.html
     #https://link.springer.com/article/10.1007/s10822-006-9085-8